@@ -1,11 +1,19 @@
 import os
 import logging
 import socket
+import threading
+import numpy as np
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import matplotlib
+matplotlib.use('Agg')  # Non-interactive backend; must be selected before importing pyplot
 import matplotlib.pyplot as plt
 from io import BytesIO
+from functools import lru_cache
 from fastapi import FastAPI, Query, HTTPException
-from fastapi.responses import StreamingResponse, HTMLResponse
+from fastapi.responses import StreamingResponse, HTMLResponse, Response
 from typing import Literal
 import uvicorn
 from contextlib import asynccontextmanager
@@ -16,6 +24,7 @@ logger = logging.getLogger(__name__)
 
 # === Utility Functions ===
 
+@lru_cache(maxsize=1)
 def get_local_ip():
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -31,66 +40,258 @@ def get_free_port():
         s.bind(('', 0))
         return s.getsockname()[1]
 
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    # Largest-Triangle-Three-Buckets: pick n_out row indices that preserve the visual shape
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    y = np.nan_to_num(y)
+    every = (n - 2) / (n_out - 2)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a])
+                      - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+def format_month(month_int: pd.Series) -> pd.Series:
+    # Integer YYYYMM key -> 'YYYY-MM' string, as the Period column used to print
+    return (month_int // 100).astype(str) + '-' + (month_int % 100).astype(str).str.zfill(2)
+
+def to_stripped_category(col: pd.Series) -> pd.Series:
+    # Strip whitespace on the (few) categories rather than on every row
+    col = col.astype('category')
+    stripped = col.cat.categories.astype(str).str.strip()
+    if stripped.is_unique:
+        # Re-sort after renaming so category order (used by every sort) stays alphabetical
+        return col.cat.rename_categories(stripped).cat.reorder_categories(sorted(stripped))
+    # Stripping merged some categories, so fall back to a row-wise strip
+    return col.str.strip().astype('category')
+
 # === Load Data ===
 
 DATA_PATH = "./Data/combined_dataset.parquet"
+# Uncompressed Arrow IPC copy of the dataset, written by the ETL notebook
+ARROW_PATH = "./Data/combined_dataset.arrow"
 
-if not os.path.exists(DATA_PATH):
+# Use the IPC copy only if it is at least as new as the parquet it was derived from
+if os.path.exists(ARROW_PATH) and (
+    not os.path.exists(DATA_PATH) or os.path.getmtime(ARROW_PATH) >= os.path.getmtime(DATA_PATH)
+):
+    # Memory-map the IPC file so startup skips parquet decompression; to_pandas() still
+    # copies the columns into each worker's own memory
+    logger.info(f"Loading dataset from {ARROW_PATH}")
+    df = pa.ipc.open_file(pa.memory_map(ARROW_PATH)).read_all().to_pandas()
+elif not os.path.exists(DATA_PATH):
     raise FileNotFoundError(f"Dataset not found at {DATA_PATH}. Please ensure it's generated and saved properly.")
-
-if DATA_PATH.endswith('.csv'):
+elif DATA_PATH.endswith('.csv'):
     df = pd.read_csv(DATA_PATH, parse_dates=['timestamp'])
 elif DATA_PATH.endswith('.parquet'):
-    df = pd.read_parquet(DATA_PATH)
+    logger.info(f"Loading dataset from {DATA_PATH}")
+    # Memory-map the file rather than reading it through buffered I/O; the decoded
+    # DataFrame is still private to each worker
+    df = pd.read_parquet(DATA_PATH, engine='pyarrow', memory_map=True)
 else:
     raise ValueError("Unsupported file format")
 
-# Recalculate time-based columns (standardizing with lower-case names)
 df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
-df['hour'] = df['timestamp'].dt.hour
-df['date'] = df['timestamp'].dt.date
-# Convert to naive datetime before creating period to avoid timezone drop warnings
-df['month'] = df['timestamp'].dt.tz_localize(None).dt.to_period("M")
 
-df['time'] = df['timestamp'].dt.time
-
-# Clean the 'Location' and 'Town' columns by stripping extra whitespace
+# Compact integer time keys (hour, days since epoch, YYYYMM) are persisted by the ETL
+# notebook; only compute them here for datasets written before they existed
+if 'hour' not in df.columns:
+    df['hour'] = df['timestamp'].dt.hour.astype('int8')
+if 'date_epoch_days' not in df.columns:
+    df['date_epoch_days'] = df['timestamp'].values.astype('datetime64[D]').view('int64').astype('int32')
+if 'month_int' not in df.columns:
+    df['month_int'] = (df['timestamp'].dt.year * 100 + df['timestamp'].dt.month).astype('int32')
+
+# Heat pump consumption (kWh) per row, also persisted by the ETL notebook
+if 'heatpump_kWh' not in df.columns:
+    df['heatpump_kWh'] = (df['total_energy_kWh'] * df['heatpump_pct'] * 0.01).astype('float32')
+
+# The file keeps float64 for the notebooks that share it; float32 halves these columns in memory here
+df['heatpump_pct'] = df['heatpump_pct'].astype('float32')
+df['total_energy_kWh'] = df['total_energy_kWh'].astype('float32')
+
+# Clean the 'Location' and 'Town' columns by stripping extra whitespace and
+# store them as categoricals so filtering compares integer codes instead of strings
 if 'Location' in df.columns:
-    df['Location'] = df['Location'].astype(str).str.strip()
+    df['Location'] = to_stripped_category(df['Location'])
 if 'Town' in df.columns:
-    df['Town'] = df['Town'].astype(str).str.strip()
+    df['Town'] = to_stripped_category(df['Town'])
+
+# Sort rows by Location (stable, so each Location keeps its original row order) so every
+# Location occupies one contiguous block, then pre-index those blocks once. Endpoints do a
+# dict lookup and get a positional slice of df instead of a mask scan or a grouped copy.
+df = df.sort_values('Location', kind='stable', ignore_index=True)
+loc_codes = df['Location'].cat.codes.to_numpy()
+loc_starts = np.r_[0, np.flatnonzero(np.diff(loc_codes)) + 1] if len(df) else np.array([], dtype=int)
+loc_stops = np.r_[loc_starts[1:], len(df)]
+LOC_INDEX = {
+    df['Location'].cat.categories[loc_codes[start]]: df.iloc[start:stop]
+    for start, stop in zip(loc_starts, loc_stops)
+    if loc_codes[start] != -1  # skip rows with a missing Location
+}
+
+# Unique (Location, Town) records sorted by Location, each paired with its lowercase Town
+# so the /locations filter is a plain substring check over a short list. A missing Town gets
+# an empty key, so only an unfiltered request lists it.
+TOWN_INDEX = [
+    (town.lower() if isinstance(town, str) else '', {"Location": loc, "Town": town})
+    for loc, town in df[['Location', 'Town']].drop_duplicates().sort_values('Location').itertuples(index=False)
+]
+ALL_LOCATIONS = [record for _, record in TOWN_INDEX]
+
+# === Precomputed Aggregations ===
+
+# Grouping keys for each /heatpump/share resolution
+SHARE_KEYS = {
+    "hourly": ['date_epoch_days', 'hour'],
+    "daily": ['date_epoch_days'],
+    "monthly": ['month_int'],
+}
+
+# Response field names for the integer time keys
+SHARE_COLUMNS = {'date_epoch_days': 'date', 'month_int': 'month'}
+
+# The dataset is static, so aggregate every (resolution, Location) pair once at startup
+# and keep the already-encoded JSON body. The group-by runs in pyarrow's C++ kernels over
+# one Arrow table holding just the key and value columns.
+share_table = pa.Table.from_pandas(
+    df[['Location', 'date_epoch_days', 'hour', 'month_int', 'heatpump_pct']], preserve_index=False
+)
+SHARE_CACHE = {}
+for resolution, keys in SHARE_KEYS.items():
+    out_keys = [SHARE_COLUMNS.get(k, k) for k in keys]
+    agg = (share_table.group_by(['Location'] + keys)
+           .aggregate([('heatpump_pct', 'mean')])
+           .to_pandas()
+           .rename(columns={'heatpump_pct_mean': 'heatpump_pct', **SHARE_COLUMNS})
+           .sort_values(['Location'] + out_keys)
+           .reindex(columns=['Location'] + out_keys + ['heatpump_pct']))
+    # Turn the integer keys back into dates/months on the (small) aggregated frame only
+    if 'date' in agg.columns:
+        agg['date'] = pd.to_datetime(agg['date'], unit='D').dt.date
+    if 'month' in agg.columns:
+        agg['month'] = format_month(agg['month'])
+    SHARE_CACHE[resolution] = {
+        loc: orjson.dumps(sub.drop(columns='Location').to_dict(orient="records"),
+                          option=orjson.OPT_SERIALIZE_NUMPY)
+        for loc, sub in agg.groupby('Location', observed=True, sort=False)
+    }
+del share_table  # only needed to build the cache
+
+# (average, max, min, row count) of heatpump_pct per Location
+SUMMARY_CACHE = {
+    loc: (float(avg_pct), float(max_pct), float(min_pct), int(count))
+    for loc, avg_pct, max_pct, min_pct, count in df.groupby('Location', observed=True)['heatpump_pct']
+                                                   .agg(['mean', 'max', 'min', 'size'])
+                                                   .itertuples(name=None)
+}
 
 # === FastAPI App Setup ===
 
 app = FastAPI(title="Heat Pump Contribution API", lifespan=None)
 
+def json_response(content) -> Response:
+    # Encode with orjson (Rust) rather than FastAPI's stdlib-json path
+    return Response(content=orjson.dumps(content), media_type="application/json")
+
 # === Helper: Generate Plot ===
 
+# Max points drawn per line; longer series are LTTB-downsampled before plotting
+PLOT_MAX_POINTS = 2000
+
+# One figure per worker, reused across requests; pyplot state is not thread-safe
+FIG, AX = plt.subplots(figsize=(10, 6))
+PLOT_LOCK = threading.Lock()
+
 def generate_comparison_plot(data: pd.DataFrame, location: str) -> BytesIO:
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.plot(data['timestamp'], data['total_energy_kWh'],
-            label='Total Consumption (kWh)', color='blue', alpha=0.6)
-    # Compute Heat Pump Consumption as total_energy_kWh * (heatpump_pct / 100)
-    ax.plot(data['timestamp'], data['total_energy_kWh'] * data['heatpump_pct'] / 100,
-            label='Heat Pump Consumption (kWh)', color='orange', alpha=0.8)
-    ax.set_title(f"Heat Pump vs Total Energy Consumption\nLocation: {location}")
-    ax.set_xlabel("Time")
-    ax.set_ylabel("Energy (kWh)")
-    ax.legend()
-    ax.grid(True)
+    timestamps = data['timestamp']
+    x = timestamps.astype('int64').to_numpy(dtype=float)
+    total = data['total_energy_kWh']
+    heatpump = data['heatpump_kWh']
+    total_idx = lttb_indices(x, total.to_numpy(dtype=float), PLOT_MAX_POINTS)
+    heatpump_idx = lttb_indices(x, heatpump.to_numpy(dtype=float), PLOT_MAX_POINTS)
 
     buf = BytesIO()
-    plt.savefig(buf, format='png')
-    plt.close(fig)
+    with PLOT_LOCK:
+        AX.clear()
+        AX.plot(timestamps.iloc[total_idx], total.iloc[total_idx],
+                label='Total Consumption (kWh)', color='blue', alpha=0.6)
+        AX.plot(timestamps.iloc[heatpump_idx], heatpump.iloc[heatpump_idx],
+                label='Heat Pump Consumption (kWh)', color='orange', alpha=0.8)
+        AX.set_title(f"Heat Pump vs Total Energy Consumption\nLocation: {location}")
+        AX.set_xlabel("Time")
+        AX.set_ylabel("Energy (kWh)")
+        AX.legend()
+        AX.grid(True)
+        FIG.savefig(buf, format='png')
     buf.seek(0)
     return buf
 
-# === API Endpoints ===
-
-@app.get("/", response_class=HTMLResponse)
-async def root():
-    logger.info("Root endpoint accessed")
-    return """
+# === Cached Renderer ===
+# The plot is deterministic for the static dataset, so keep the raw PNG bytes per Location.
+# Bytes (not BytesIO) are cached because a BytesIO is consumed by the response.
+
+@lru_cache(maxsize=256)
+def _plot_png(location: str) -> bytes:
+    return generate_comparison_plot(LOC_INDEX[location], location).getvalue()
+
+# === Helper: Stream Report ===
+
+# Rows per CSV chunk sent to the client
+REPORT_BATCH_ROWS = 10_000
+
+# Quote only the fields that need it, as DataFrame.to_csv does
+CSV_WRITE_OPTIONS = pacsv.WriteOptions(quoting_style="needed")
+
+def csv_table(data: pd.DataFrame) -> pa.Table:
+    # Pre-format datetime and time-of-day columns the way DataFrame.to_csv prints them;
+    # pyarrow would write e.g. '2024-01-30 20:00:00.000000Z' and '20:00:00.000000'
+    data = data.copy(deep=False)
+    for col in data.columns:
+        values = data[col]
+        if isinstance(values.dtype, pd.DatetimeTZDtype):
+            formatted = values.dt.strftime('%Y-%m-%d %H:%M:%S%z')
+            data[col] = formatted.str[:-2] + ':' + formatted.str[-2:]
+        elif pd.api.types.is_datetime64_dtype(values.dtype):
+            data[col] = values.dt.strftime('%Y-%m-%d %H:%M:%S')
+        elif values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) == 'time':
+            data[col] = values.where(values.isna(), values.astype(str))
+    return pa.Table.from_pandas(data, preserve_index=False)
+
+def report_frame(location: str) -> pd.DataFrame:
+    # Swap the integer grouping keys for readable date (YYYY-MM-DD) and month (YYYY-MM) columns
+    location_df = LOC_INDEX[location]
+    data = location_df.drop(columns=['date_epoch_days', 'month_int'])
+    data['date'] = pd.to_datetime(location_df['date_epoch_days'], unit='D').dt.date
+    data['month'] = format_month(location_df['month_int'])
+    return data
+
+def iter_report_csv(location: str):
+    # Encode one record batch at a time with pyarrow's C++ CSV writer, so only a
+    # single chunk of CSV text is held in memory before it is sent
+    table = csv_table(report_frame(location))
+    sink = BytesIO()
+    writer = pacsv.CSVWriter(sink, table.schema, write_options=CSV_WRITE_OPTIONS)
+    for batch in table.to_batches(max_chunksize=REPORT_BATCH_ROWS):
+        writer.write_batch(batch)
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    writer.close()
+
+# === Instruction Manual ===
+
+# Static page, encoded once at import
+MANUAL_HTML_BYTES = """
     <html>
         <head>
             <title>Heat Pump Contribution API Manual</title>
@@ -128,9 +329,10 @@ async def root():
           </ul>
         </li>
         <li>
-          <strong>GET /heatpump/report</strong>: Downloads a CSV report with detailed data for a given location.
+          <strong>GET /heatpump/report</strong>: Downloads a CSV or Parquet report with detailed data for a given location.
           <ul>
             <li><code>location</code> (required): The location name or ID.</li>
+            <li><code>format</code> (optional): File format; options: csv, parquet (default: csv).</li>
           </ul>
         </li>
         <li>
@@ -144,11 +346,20 @@ async def root():
       <p>Examples:</p>
       <pre>GET /heatpump/share?location=tregattu%2011&amp;resolution=daily</pre>
       <pre>GET /heatpump/report?location=tregattu%2011</pre>
+      <pre>GET /heatpump/report?location=tregattu%2011&amp;format=parquet</pre>
       <pre>GET /locations?Town=SomeTown</pre>
       <p>Interactive API documentation is available at: <code>/docs</code></p>
     </body>
     </html>
-    """
+""".encode('utf-8')
+
+# === API Endpoints ===
+
+@app.get("/", response_class=HTMLResponse)
+async def root():
+    logger.info("Root endpoint accessed")
+    return Response(content=MANUAL_HTML_BYTES, media_type="text/html",
+                    headers={"Cache-Control": "public, max-age=3600"})
 
 @app.get("/health")
 def health_check():
@@ -156,79 +367,70 @@ def health_check():
     return {"status": "ok"}
 
 @app.get("/locations")
-async def list_locations(Town: str = Query(None, description="Optional Town filter to narrow the list")):
-    if Town:
-        filtered_df = df[df['Town'].str.contains(Town, case=False, na=False)]
-    else:
-        filtered_df = df
+def list_locations(Town: str = Query(None, description="Optional Town filter to narrow the list")):
     # Return a list of dictionaries: each dictionary contains Location and its associated Town.
-    locs = filtered_df[['Location', 'Town']].drop_duplicates().sort_values('Location')
-    locations_list = locs.to_dict(orient="records")
-    return {"locations": locations_list}
+    if not Town:
+        return json_response({"locations": ALL_LOCATIONS})
+    query = Town.lower()
+    locations_list = [record for town_lower, record in TOWN_INDEX if query in town_lower]
+    return json_response({"locations": locations_list})
 
 @app.get("/heatpump/share")
-async def get_heatpump_share(
+def get_heatpump_share(
     location: str = Query(..., description="Location name or ID"),
     resolution: Literal["hourly", "daily", "monthly"] = Query("daily")
 ):
-    location_df = df[df['Location'] == location]
-
-    if location_df.empty:
+    body = SHARE_CACHE[resolution].get(location)
+    if body is None:
         raise HTTPException(status_code=404, detail="Location not found")
 
-    if resolution == "hourly":
-        # Group by 'date' and 'hour'
-        res = location_df.groupby(['date', 'hour'])['heatpump_pct'].mean().reset_index()
-    elif resolution == "daily":
-        # Group by 'date'
-        res = location_df.groupby(['date'])['heatpump_pct'].mean().reset_index()
-    else:  # monthly
-        # Group by 'month'
-        res = location_df.groupby(['month'])['heatpump_pct'].mean().reset_index()
-
-    return res.to_dict(orient="records")
+    return Response(content=body, media_type="application/json")
 
 @app.get("/heatpump/summary")
-async def get_summary_metrics(
+def get_summary_metrics(
     location: str = Query(..., description="Location name or ID")
 ):
-    location_df = df[df['Location'] == location]
-    if location_df.empty:
+    metrics = SUMMARY_CACHE.get(location)
+    if metrics is None:
         raise HTTPException(status_code=404, detail="Location not found")
-    
-    avg_pct = location_df['heatpump_pct'].mean()
-    max_pct = location_df['heatpump_pct'].max()
-    min_pct = location_df['heatpump_pct'].min()
-    
-    return {
+
+    avg_pct, max_pct, min_pct, data_points = metrics
+
+    return json_response({
         "location": location,
         "average_heatpump_pct": round(avg_pct, 2),
         "max_heatpump_pct": round(max_pct, 2),
         "min_heatpump_pct": round(min_pct, 2),
-        "data_points": len(location_df)
-    }
+        "data_points": data_points
+    })
 
 @app.get("/heatpump/plot")
-async def get_heatpump_plot(
+def get_heatpump_plot(
     location: str = Query(..., description="Location name or ID")
 ):
-    location_df = df[df['Location'] == location]
-    if location_df.empty:
+    if location not in LOC_INDEX:
         raise HTTPException(status_code=404, detail="Location not found")
-    
-    buf = generate_comparison_plot(location_df, location)
-    return StreamingResponse(buf, media_type="image/png")
+
+    return StreamingResponse(BytesIO(_plot_png(location)), media_type="image/png")
 
 @app.get("/heatpump/report")
-async def download_report(
-    location: str = Query(..., description="Location name or ID")
+def download_report(
+    location: str = Query(..., description="Location name or ID"),
+    format: Literal["csv", "parquet"] = Query("csv")
 ):
-    location_df = df[df['Location'] == location]
-    if location_df.empty:
+    if location not in LOC_INDEX:
         raise HTTPException(status_code=404, detail="Location not found")
 
-    csv_bytes = location_df.to_csv(index=False).encode('utf-8')
-    return StreamingResponse(BytesIO(csv_bytes), media_type="text/csv", headers={
+    if format == "parquet":
+        # Columnar and compressed: much smaller on the wire than CSV, and keeps dtypes
+        buf = BytesIO()
+        report_frame(location).to_parquet(buf, engine='pyarrow', compression='snappy', index=False)
+        buf.seek(0)
+        return StreamingResponse(buf, media_type="application/vnd.apache.parquet", headers={
+            "Content-Disposition": f"attachment; filename={location}_report.parquet"
+        })
+
+    return StreamingResponse(iter_report_csv(location), media_type="text/csv", headers={
         "Content-Disposition": f"attachment; filename={location}_report.csv"
     })
 
@@ -241,8 +443,9 @@ async def lifespan(app: FastAPI):
 # === Main Entrypoint ===
 
 if __name__ == "__main__":
-    host = os.getenv("FASTAPI_HOST", get_local_ip())
-    port = int(os.getenv("FASTAPI_PORT", get_free_port()))
+    # Only probe the network for a host/port when they are not configured
+    host = os.getenv("FASTAPI_HOST") or get_local_ip()
+    port = int(os.getenv("FASTAPI_PORT") or get_free_port())
 
     # Print detailed instructions for the end user:
     instructions = (
@@ -263,8 +466,10 @@ if __name__ == "__main__":
         "   - Parameter: location (required)\n"
         "   - Returns a PNG plot comparing total consumption vs. heat pump consumption.\n\n"
         "5. GET /heatpump/report\n"
-        "   - Parameter: location (required)\n"
-        "   - Downloads a CSV report with detailed data for the location.\n\n"
+        "   - Parameters:\n"
+        "       * location (required): Location name or ID\n"
+        "       * format (optional): 'csv' or 'parquet' (default: csv)\n"
+        "   - Downloads a CSV or Parquet report with detailed data for the location.\n\n"
         "6. GET /locations\n"
         "   - Optional Parameter: Town (to filter the list by Town)\n"
         "   - Returns a list of all unique locations along with their associated counties available in the dataset.\n\n"
@@ -274,4 +479,8 @@ if __name__ == "__main__":
 
     print(instructions)
     print(f"Starting FastAPI at http://{host}:{port}/docs")
-    uvicorn.run("app:app", host=host, port=port, reload=True)
+    # The autoreloader runs a file watcher alongside the server; only enable it for development
+    reload = os.getenv("FASTAPI_RELOAD", "0") == "1"
+    # Single process here: spawned workers would re-import this script as __mp_main__ and load the
+    # dataset before answering the supervisor's ping. Use `uvicorn app:app --workers N` for more.
+    uvicorn.run("app:app", host=host, port=port, reload=reload)